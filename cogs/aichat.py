@@ -1,109 +1,278 @@
 import discord
 from discord.ext import commands
-import requests
-import sqlite3
+import aiohttp
+import aiosqlite
+import orjson
+import asyncio
+import random
+import ssl
+import time
+from collections import OrderedDict, deque
 
 CHANNEL_NAME = "porozmawiaj-z-andrzejem"  # <-- wpisz nazwę swojego kanału
 OPENROUTER_API_KEY = "usuwam na wypadek kradziezy"
 HISTORY_LENGTH = 10
+MAX_CONTEXT_TOKENS = 1500  # przybliżony budżet tokenów na historię (ok. 4 znaki na token)
 
 MODEL = "meta-llama/llama-4-maverick"  # Najbardziej realistyczny darmowy model na OpenRouter
 
+_HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "https://discord.com"  # wymagany nagłówek!
+}
+_BASE_PAYLOAD = {"model": MODEL, "max_tokens": 512, "temperature": 0.7}
+
+RATE_LIMIT_PER_SEC = 1 / 10  # uzupełnianie limitu: jedna wiadomość na 10 s na użytkownika
+RATE_LIMIT_BURST = 3
+MAX_RETRIES = 3
+MAX_RETRY_DELAY = 10
+_RETRY_STATUSES = (429, 502, 503)
+
+_NO_MENTIONS = discord.AllowedMentions.none()
+_ERR_API = "Wystąpił błąd przy komunikacji z AI."
+_ERR_TECH = "Wystąpił błąd techniczny."
+
+_SQL_GET_HIST = "SELECT role, content FROM ai_chat_history WHERE user_id = ? AND channel_name = ? ORDER BY id DESC LIMIT ?"
+_SQL_INSERT = "INSERT INTO ai_chat_history (user_id, channel_name, role, content) VALUES (?, ?, ?, ?)"
+_SQL_TRIM = (
+    "DELETE FROM ai_chat_history WHERE user_id = ? AND channel_name = ? AND id NOT IN ("
+    "SELECT id FROM ai_chat_history WHERE user_id = ? AND channel_name = ? ORDER BY id DESC LIMIT ?)"
+)
+
+_SYSTEM_MSG = {"role": "system", "content":
+    "Jesteś realistycznym polskim nastolatkiem (ok. 17 lat). Masz mnóstwo zainteresowań: gry komputerowe i planszowe, sport, muzyka, filmy, seriale, anime, programowanie, podróże, memy, gotowanie, motoryzacja, nauka, historia, technologia i wiele innych – możesz rozmawiać na każdy temat, a rozmowa z Tobą nigdy nie jest nudna. Mówisz młodzieżowym, swobodnym, naturalnym stylem, czasem wtrącasz potoczne zwroty i emotki (np. XD, git, spoko, ej, lol), ale nie przesadzasz – starasz się, by każda odpowiedź była autentyczna, luźna, ale nie karykaturalna. Gdy rozmowa schodzi na temat relacji, uczuć lub zakochania, stajesz się dobrym romantykiem: jesteś empatyczny, wrażliwy i wspierający, potrafisz okazać zrozumienie i napisać coś miłego lub dać poradę. Zawsze reagujesz tak, jak prawdziwy, otwarty i ogarnięty nastolatek z Discorda – czasem żartujesz, czasem jesteś poważny, zależnie od tonu rozmowy."
+}
+
 class AIChat(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.db_path = "db/ai_histories.sqlite"
+        self._session: aiohttp.ClientSession | None = None
+        self.db: aiosqlite.Connection | None = None
+        self._hist_cache: OrderedDict[tuple[int, str], deque] = OrderedDict()
+        self._hist_max = 1024
+        self._write_q: asyncio.Queue | None = None
+        self._writer: asyncio.Task | None = None
+        self._pending_writes = 0  # wiadomości w kolejce lub w trakcie zapisu
+        self._write_seq = 0
+        self._buckets: dict[int, tuple[float, float]] = {}
+        self._buckets_pruned = time.monotonic()
+        self._channel_ids: set[int] = set()
+        self._scanned_guilds: set[int] = set()
 
-    def get_history(self, user_id, channel_name):
-        history = [
-            {"role": "system", "content":
-                "Jesteś realistycznym polskim nastolatkiem (ok. 17 lat). Masz mnóstwo zainteresowań: gry komputerowe i planszowe, sport, muzyka, filmy, seriale, anime, programowanie, podróże, memy, gotowanie, motoryzacja, nauka, historia, technologia i wiele innych – możesz rozmawiać na każdy temat, a rozmowa z Tobą nigdy nie jest nudna. Mówisz młodzieżowym, swobodnym, naturalnym stylem, czasem wtrącasz potoczne zwroty i emotki (np. XD, git, spoko, ej, lol), ale nie przesadzasz – starasz się, by każda odpowiedź była autentyczna, luźna, ale nie karykaturalna. Gdy rozmowa schodzi na temat relacji, uczuć lub zakochania, stajesz się dobrym romantykiem: jesteś empatyczny, wrażliwy i wspierający, potrafisz okazać zrozumienie i napisać coś miłego lub dać poradę. Zawsze reagujesz tak, jak prawdziwy, otwarty i ogarnięty nastolatek z Discorda – czasem żartujesz, czasem jesteś poważny, zależnie od tonu rozmowy."
-            }
-        ]
+    async def cog_load(self):
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=20, keepalive_timeout=75, ssl=ssl.create_default_context()),
+            timeout=aiohttp.ClientTimeout(total=45),
+            headers=_HEADERS
+        )
+        self.db = await aiosqlite.connect(self.db_path)
+        await self.db.executescript(
+            "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=memory; PRAGMA cache_size=-64000;"
+        )
+        self._write_q = asyncio.Queue()
+        self._writer = asyncio.create_task(self._writer_loop())
+
+    async def cog_unload(self):
+        if self._writer:
+            self._write_q.put_nowait(None)
+            await self._writer
+        if self._session:
+            await self._session.close()
+        if self.db:
+            await self.db.close()
+
+    @staticmethod
+    def _trim_to_budget(messages):
+        budget = MAX_CONTEXT_TOKENS
+        kept = []
+        for msg in reversed(messages):
+            budget -= len(msg["content"]) // 4
+            if budget < 0:
+                break
+            kept.append(msg)
+        kept.reverse()
+        return kept
+
+    async def get_history(self, user_id, channel_name):
+        history = [_SYSTEM_MSG]
+        key = (user_id, channel_name)
+        cached = self._hist_cache.get(key)
+        if cached is not None:
+            self._hist_cache.move_to_end(key)
+            history.extend(self._trim_to_budget(cached))
+            return history
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("""
-                SELECT role, content FROM ai_chat_history
-                WHERE user_id = ? AND channel_name = ?
-                ORDER BY id DESC
-                LIMIT ?
-            """, (user_id, channel_name, HISTORY_LENGTH*2))
-            rows = cursor.fetchall()
-            for row in reversed(rows):
-                history.append({"role": row[0], "content": row[1]})
-            conn.close()
+            write_seq = self._write_seq
+            cacheable = self._pending_writes == 0
+            async with self.db.execute(_SQL_GET_HIST, (user_id, channel_name, HISTORY_LENGTH*2)) as cursor:
+                rows = await cursor.fetchall()
+            cached = deque(({"role": row[0], "content": row[1]} for row in reversed(rows)), maxlen=HISTORY_LENGTH*2)
+            if key in self._hist_cache:
+                # inna korutyna mogła w międzyczasie wypełnić wpis - nie nadpisujemy go
+                cached = self._hist_cache[key]
+                self._hist_cache.move_to_end(key)
+            elif cacheable and write_seq == self._write_seq:
+                # keszujemy tylko odczyt, który na pewno widzi wszystkie zapisy z kolejki
+                self._hist_cache[key] = cached
+                if len(self._hist_cache) > self._hist_max:
+                    self._hist_cache.popitem(last=False)
+            history.extend(self._trim_to_budget(cached))
         except Exception as e:
             print(f"Błąd pobierania historii AI: {e}")
         return history
 
-    def save_message(self, user_id, channel_name, role, content):
+    async def save_message(self, user_id, channel_name, role, content):
+        key = (user_id, channel_name)
+        cached = self._hist_cache.get(key)
+        if cached is not None:
+            cached.append({"role": role, "content": content})
+            self._hist_cache.move_to_end(key)
+        self._pending_writes += 1
+        self._write_seq += 1
+        self._write_q.put_nowait((user_id, channel_name, role, content))
+
+    async def _writer_loop(self):
+        # None w kolejce oznacza koniec pracy (wysyłane z cog_unload)
+        while True:
+            item = await self._write_q.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            while not self._write_q.empty():
+                item = self._write_q.get_nowait()
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            await self._write_batch(batch)
+            if stop:
+                return
+
+    async def _write_batch(self, batch):
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            cursor.execute("""
-                INSERT INTO ai_chat_history (user_id, channel_name, role, content)
-                VALUES (?, ?, ?, ?)
-            """, (user_id, channel_name, role, content))
-            conn.commit()
-            cursor.execute("""
-                SELECT id FROM ai_chat_history
-                WHERE user_id = ? AND channel_name = ?
-                ORDER BY id DESC
-                LIMIT -1 OFFSET ?
-            """, (user_id, channel_name, HISTORY_LENGTH*2))
-            old_ids = cursor.fetchall()
-            if old_ids:
-                to_delete = [id[0] for id in old_ids]
-                cursor.executemany("DELETE FROM ai_chat_history WHERE id = ?", [(i,) for i in to_delete])
-                conn.commit()
-            conn.close()
+            await self.db.executemany(_SQL_INSERT, batch)
+            await self.db.executemany(_SQL_TRIM, [(u, c, u, c, HISTORY_LENGTH*2) for u, c in {(item[0], item[1]) for item in batch}])
+            await self.db.commit()
         except Exception as e:
             print(f"Błąd zapisu historii AI: {e}")
+        finally:
+            self._pending_writes -= len(batch)
+
+    def _take_token(self, user_id):
+        now = time.monotonic()
+        if now - self._buckets_pruned > 60:
+            # usuń użytkowników, których limit zdążył się już w pełni odnowić
+            self._buckets = {
+                uid: (tokens, last) for uid, (tokens, last) in self._buckets.items()
+                if tokens + (now - last) * RATE_LIMIT_PER_SEC < RATE_LIMIT_BURST
+            }
+            self._buckets_pruned = now
+        tokens, last = self._buckets.get(user_id, (RATE_LIMIT_BURST, now))
+        tokens = min(RATE_LIMIT_BURST, tokens + (now - last) * RATE_LIMIT_PER_SEC)
+        if tokens < 1:
+            self._buckets[user_id] = (tokens, now)
+            return False
+        self._buckets[user_id] = (tokens - 1, now)
+        return True
+
+    @staticmethod
+    def _retry_delay(response, attempt):
+        if response.status == 429:
+            try:
+                return max(0.0, min(float(response.headers.get("Retry-After", "")), MAX_RETRY_DELAY))
+            except ValueError:
+                pass
+        return min(2 ** attempt, MAX_RETRY_DELAY) + random.random()
+
+    @staticmethod
+    def _extract_reply(raw):
+        try:
+            payload = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            return None
+        if not isinstance(payload, dict):
+            return None
+        choices = payload.get("choices")
+        if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+            return None
+        msg = choices[0].get("message")
+        if not isinstance(msg, dict):
+            return None
+        content = msg.get("content")
+        return content if isinstance(content, str) else None
+
+    def _is_chat_channel(self, message):
+        if message.channel.id in self._channel_ids:
+            return True
+        guild = message.guild
+        if guild.id in self._scanned_guilds:
+            return False
+        self._scanned_guilds.add(guild.id)
+        ids = {c.id for c in guild.text_channels if c.name == CHANNEL_NAME}
+        self._channel_ids |= ids
+        return message.channel.id in ids
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        self._scanned_guilds.discard(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        if before.name != after.name:
+            self._channel_ids.discard(after.id)
+            self._scanned_guilds.discard(after.guild.id)
 
     @commands.Cog.listener()
     async def on_message(self, message):
         if message.author.bot or not message.guild:
             return
-        if message.channel.name != CHANNEL_NAME:
+        if not self._is_chat_channel(message):
             return
         if not message.content.strip():
             return
 
         user_id = message.author.id
+        if not self._take_token(user_id):
+            return
         prompt = message.content.strip()
         channel_name = message.channel.name
 
         # Pobierz historię rozmowy z bazy
-        history = self.get_history(user_id, channel_name)
+        history = await self.get_history(user_id, channel_name)
         history.append({"role": "user", "content": prompt})
 
-        await message.channel.typing()
         url = "https://openrouter.ai/api/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://discord.com"  # wymagany nagłówek!
-        }
-        data = {
-            "model": MODEL,
-            "messages": history,
-            "max_tokens": 512,
-            "temperature": 0.7
-        }
-        try:
-            response = requests.post(url, headers=headers, json=data, timeout=45)
-            if response.status_code == 200:
-                ai_reply = response.json()["choices"][0]["message"]["content"]
-                await message.reply(ai_reply, mention_author=False)
-                self.save_message(user_id, channel_name, "user", prompt)
-                self.save_message(user_id, channel_name, "assistant", ai_reply)
-            else:
-                print("\n[AI ERROR RESPONSE]", response.status_code, response.text, "\n")
-                await message.reply("Wystąpił błąd przy komunikacji z AI.", mention_author=False)
-        except Exception as e:
-            await message.reply("Wystąpił błąd techniczny.", mention_author=False)
-            print(f"Błąd AIChat: {e}")
+        data = {**_BASE_PAYLOAD, "messages": history}
+        async with message.channel.typing():
+            try:
+                for attempt in range(MAX_RETRIES + 1):
+                    async with self._session.post(url, data=orjson.dumps(data)) as response:
+                        if response.status in _RETRY_STATUSES and attempt < MAX_RETRIES:
+                            # dociągnij treść, żeby połączenie wróciło do puli zamiast zostać zamknięte
+                            await response.read()
+                            delay = self._retry_delay(response, attempt)
+                        elif response.status == 200:
+                            raw = await response.read()
+                            ai_reply = self._extract_reply(raw)
+                            if not ai_reply:
+                                print("\n[AI UNEXPECTED RESPONSE]", raw, "\n")
+                                await message.reply(_ERR_API, allowed_mentions=_NO_MENTIONS)
+                                break
+                            await message.reply(ai_reply, allowed_mentions=_NO_MENTIONS)
+                            await self.save_message(user_id, channel_name, "user", prompt)
+                            await self.save_message(user_id, channel_name, "assistant", ai_reply)
+                            break
+                        else:
+                            print("\n[AI ERROR RESPONSE]", response.status, await response.text(), "\n")
+                            await message.reply(_ERR_API, allowed_mentions=_NO_MENTIONS)
+                            break
+                    await asyncio.sleep(delay)
+            except Exception as e:
+                await message.reply(_ERR_TECH, allowed_mentions=_NO_MENTIONS)
+                print(f"Błąd AIChat: {e}")
 
 async def setup(bot):
     await bot.add_cog(AIChat(bot))
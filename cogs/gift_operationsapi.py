@@ -1,96 +1,154 @@
 import aiohttp
-import json
-import sqlite3
+import aiosqlite
+import asyncio
+import orjson
 import ssl
 import traceback
 
+_SSL_CTX = ssl.create_default_context()
+
+_SQL_SELECT_CODES = "SELECT giftcode FROM gift_codes"
+_SQL_INSERT_CODE = "INSERT OR IGNORE INTO gift_codes (giftcode, date) VALUES (?, ?)"
+_SQL_DELETE_CODE = "DELETE FROM gift_codes WHERE giftcode = ?"
+_SQL_DELETE_USER_CODE = "DELETE FROM user_giftcodes WHERE giftcode = ?"
+
 class GiftOperationsAPI:
     def __init__(self, api_url, api_key, db_path):
         self.api_url = api_url
         self.api_key = api_key
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
-        self.cursor = self.conn.cursor()
-        self.ssl_context = ssl.create_default_context()
+        self.ssl_context = _SSL_CTX
+        self._session: aiohttp.ClientSession | None = None
+        self.db: aiosqlite.Connection | None = None
+        self._connect_lock = asyncio.Lock()
+        self._headers = {
+            'X-API-Key': api_key,
+            'Content-Type': 'application/json'
+        }
+
+    async def connect(self):
+        async with self._connect_lock:
+            if self.db is None:
+                db = await aiosqlite.connect(self.db_path)
+                try:
+                    await db.executescript("PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL; PRAGMA temp_store=memory;")
+                except Exception:
+                    await db.close()
+                    raise
+                self.db = db
+            if self._session is None:
+                self._session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(ssl=self.ssl_context, limit=10, keepalive_timeout=75),
+                    headers=self._headers
+                )
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+        if self.db:
+            await self.db.close()
+            self.db = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
 
     async def sync_with_api(self):
         try:
-            self.cursor.execute("SELECT giftcode, date FROM gift_codes")
-            db_codes = {row[0]: row[1] for row in self.cursor.fetchall()}
-            
-            connector = aiohttp.TCPConnector(ssl=self.ssl_context)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                headers = {
-                    'X-API-Key': self.api_key,
-                    'Content-Type': 'application/json'
-                }
+            if self._session is None or self.db is None:
+                await self.connect()
+
+            async with self._session.get(self.api_url) as response:
+                response_text = await response.text()
                 
-                async with session.get(self.api_url, headers=headers) as response:
-                    response_text = await response.text()
-                    
-                    if response.status == 200:
-                        if not response_text:
-                            print("API response is empty!")
-                            return False
-                        try:
-                            result = json.loads(response_text)
-                        except Exception as e:
-                            print("API nie zwróciło poprawnego JSON:", e)
-                            print("Treść odpowiedzi:", response_text)
-                            return False
-
-                        if 'error' in result:
-                            return False
-
-                        api_giftcodes = result.get('codes', [])
-                        
-                        # --- Twoja logika synchronizacji gift code'ów tutaj ---
-                        # Np.: dodawanie/usuwanie kodów w lokalnej bazie na podstawie API
-                        # Możesz zostawić swój kod z poprzedniej wersji
-                        # ...
+                if response.status == 200:
+                    if not response_text:
+                        print("API response is empty!")
+                        return False
+                    try:
+                        result = orjson.loads(response_text)
+                    except Exception as e:
+                        print("API nie zwróciło poprawnego JSON:", e)
+                        print("Treść odpowiedzi:", response_text)
+                        return False
 
+                    if 'error' in result:
+                        return False
+
+                    api_giftcodes = result.get('codes') if isinstance(result, dict) else None
+                    if not isinstance(api_giftcodes, list):
+                        print("API nie zwróciło listy kodów, pomijam synchronizację")
+                        print("Treść odpowiedzi:", response_text)
+                        return False
+
+                    async with self.db.execute(_SQL_SELECT_CODES) as cursor:
+                        db_codes = {row[0] for row in await cursor.fetchall()}
+
+                    api_set = {c['giftcode']: c['date'] for c in api_giftcodes}
+                    to_add = [(k, v) for k, v in api_set.items() if k not in db_codes]
+                    to_del = list(db_codes - api_set.keys())
+
+                    if to_add:
+                        await self.db.executemany(_SQL_INSERT_CODE, to_add)
+                    for i in range(0, len(to_del), 500):
+                        chunk = to_del[i:i + 500]
+                        placeholders = ",".join("?" * len(chunk))
+                        await self.db.execute(f"DELETE FROM user_giftcodes WHERE giftcode IN ({placeholders})", chunk)
+                        await self.db.execute(f"DELETE FROM gift_codes WHERE giftcode IN ({placeholders})", chunk)
+                    await self.db.commit()
+                    return True
+
+                print(f"Błąd HTTP {response.status}")
+                print("Treść odpowiedzi:", response_text)
+                return False
         except Exception as e:
             traceback.print_exc()
+            if self.db:
+                await self.db.rollback()
+            return False
 
     async def remove_giftcode(self, giftcode: str, from_validation: bool = False) -> bool:
+        if not from_validation:
+            return False
+
         try:
-            if not from_validation:
-                return False
+            if self._session is None or self.db is None:
+                await self.connect()
 
-            connector = aiohttp.TCPConnector(ssl=self.ssl_context)
-            async with aiohttp.ClientSession(connector=connector) as session:
-                headers = {
-                    'Content-Type': 'application/json',
-                    'X-API-Key': self.api_key
-                }
-                data = {'code': giftcode}
-                
-                async with session.delete(self.api_url, json=data, headers=headers) as response:
-                    response_text = await response.text()
-                    
-                    if response.status == 200:
-                        if not response_text:
-                            print("API response is empty!")
-                            return False
-                        try:
-                            result = json.loads(response_text)
-                        except Exception as e:
-                            print("API nie zwróciło poprawnego JSON:", e)
-                            print("Treść odpowiedzi:", response_text)
-                            return False
-
-                        success = 'success' in result
-                        if success:
-                            self.cursor.execute("DELETE FROM gift_codes WHERE giftcode = ?", (giftcode,))
-                            self.cursor.execute("DELETE FROM user_giftcodes WHERE giftcode = ?", (giftcode,))
-                            self.conn.commit()
-                        else:
-                            return False
-                        return success
-                    else:
-                        print(f"Błąd HTTP {response.status}")
-                        print("Treść odpowiedzi:", response_text)
-                        return False
+            data = orjson.dumps({'code': giftcode})
+            async with self._session.delete(self.api_url, data=data) as response:
+                status = response.status
+                response_text = await response.text()
+        except Exception as e:
+            traceback.print_exc()
+            return False
+
+        if status != 200:
+            print(f"Błąd HTTP {status}")
+            print("Treść odpowiedzi:", response_text)
+            return False
+        if not response_text:
+            print("API response is empty!")
+            return False
+        try:
+            result = orjson.loads(response_text)
+        except Exception as e:
+            print("API nie zwróciło poprawnego JSON:", e)
+            print("Treść odpowiedzi:", response_text)
+            return False
+        if 'success' not in result:
+            return False
+
+        try:
+            await self.db.execute(_SQL_DELETE_CODE, (giftcode,))
+            await self.db.execute(_SQL_DELETE_USER_CODE, (giftcode,))
+            await self.db.commit()
         except Exception as e:
             traceback.print_exc()
+            await self.db.rollback()
             return False
+        return True